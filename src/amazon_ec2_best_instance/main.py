@@ -1,18 +1,48 @@
 import boto3
+import collections
 import json
 import logging
 import os
 import operator
+import time
 import hashlib
-from datetime import datetime
+import heapq
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from .SpotUtils import SpotUtils
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+_OS_PRODUCT_DESCRIPTION_MAP = {
+    'Linux/UNIX': 'Linux',
+    'Red Hat Enterprise Linux': 'RHEL',
+    'SUSE Linux': 'SUSE',
+    'Windows': 'Windows',
+    'Linux/UNIX (Amazon VPC)': 'Linux',
+    'Red Hat Enterprise Linux (Amazon VPC)': 'RHEL',
+    'SUSE Linux (Amazon VPC)': 'SUSE',
+    'Windows (Amazon VPC)': 'Windows'
+}
+
+_VALID_PRODUCT_DESCRIPTIONS = frozenset(_OS_PRODUCT_DESCRIPTION_MAP)
+
 
 class Ec2BestInstance:
     __DESCRIBE_SPOT_PRICE_HISTORY_CONCURRENCY = 10
     __DESCRIBE_ON_DEMAND_PRICE_CONCURRENCY = 10
     __CACHE_TTL_IN_MINUTES = 120
-    __cache = {}
+    __CACHE_MAX_ENTRIES = 256
+    __ON_DEMAND_PRICE_LOOKUP_MAX_INSTANCE_TYPES = 100
+    __DESCRIBE_SPOT_PRICE_HISTORY_BATCH_SIZE = 100
+    __instance_types_cache = {}
+    __ec2_price_cache = {}
+    __interruption_frequencies_cache = {}
+    __missing_interruption_frequencies_cache = {}
 
     __REGIONS = {
         'us-east-2': 'US East (Ohio)',
@@ -38,19 +68,11 @@ class Ec2BestInstance:
         'sa-east-1': 'South America (Sao Paulo)'
     }
 
-    __OS_PRODUCT_DESCRIPTION_MAP = {
-        'Linux/UNIX': 'Linux',
-        'Red Hat Enterprise Linux': 'RHEL',
-        'SUSE Linux': 'SUSE',
-        'Windows': 'Windows',
-        'Linux/UNIX (Amazon VPC)': 'Linux',
-        'Red Hat Enterprise Linux (Amazon VPC)': 'RHEL',
-        'SUSE Linux (Amazon VPC)': 'SUSE',
-        'Windows (Amazon VPC)': 'Windows'
-    }
-
     def __init__(self, options={}, logger=None):
         self.__CACHE_TTL_IN_MINUTES = options.get('cache_ttl_in_minutes', self.__CACHE_TTL_IN_MINUTES)
+        self.__ttl_seconds = self.__CACHE_TTL_IN_MINUTES * 60
+        self.__cache_max_entries = options.get('cache_max_entries', self.__CACHE_MAX_ENTRIES)
+        self.__cache = collections.OrderedDict()
 
         if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') is None:
             from multiprocessing.pool import ThreadPool as Pool
@@ -67,38 +89,74 @@ class Ec2BestInstance:
             self.__describe_spot_price_history_concurrency = options.get('describe_spot_price_history_concurrency')
         if options.get('describe_on_demand_price_concurrency'):
             self.__describe_on_demand_price_concurrency = options.get('describe_on_demand_price_concurrency')
-        if options.get('clients') is not None and options['clients'].get('ec2') is not None:
-            self.__ec2_client = options['clients']['ec2']
-        else:
-            self.__ec2_client = boto3.session.Session().client('ec2', region_name=self.__region)
-        if options.get('clients') is not None and options['clients'].get('pricing') is not None:
-            self.__pricing_client = options['clients']['pricing']
+        # Long-lived executors keep the same worker threads, and so the same pooled connections, across calls.
+        # LambdaThreadPool is still used on AWS Lambda. The executors are released by close().
+        if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') is None:
+            self.__spot_executor = ThreadPoolExecutor(max_workers=self.__describe_spot_price_history_concurrency,
+                                                      thread_name_prefix='spot')
+            self.__on_demand_executor = ThreadPoolExecutor(max_workers=self.__describe_on_demand_price_concurrency,
+                                                           thread_name_prefix='on-demand')
         else:
-            self.__pricing_client = boto3.session.Session().client('pricing', region_name='us-east-1')
+            self.__spot_executor = None
+            self.__on_demand_executor = None
+        clients = options.get('clients') or {}
+        self.__ec2_client = clients.get('ec2')
+        self.__pricing_client = clients.get('pricing')
+        if self.__ec2_client is None or self.__pricing_client is None:
+            # The default urllib3 pool holds 10 connections, so size it to the thread pools
+            # to avoid discarding connections and re-doing TLS handshakes under concurrency.
+            client_config = Config(
+                max_pool_connections=max(self.__describe_spot_price_history_concurrency,
+                                         self.__describe_on_demand_price_concurrency) + 4,
+                retries={
+                    'max_attempts': 10,
+                    'mode': 'adaptive'
+                }
+            )
+            session = boto3.session.Session()
+            if self.__ec2_client is None:
+                self.__ec2_client = session.client('ec2', region_name=self.__region, config=client_config)
+            if self.__pricing_client is None:
+                self.__pricing_client = session.client('pricing', region_name='us-east-1', config=client_config)
         self.__logger = logger if logger is not None else logging.getLogger()
+        logging.getLogger("urllib3").setLevel(logging.ERROR)
+        self.__spot_utils = None
+
+    def close(self):
+        for executor in (self.__spot_executor, self.__on_demand_executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def get_best_instance_types(self, options={}):
-        hash_digest = self.get_hash(options)
-        if self.__cache.get(hash_digest) is not None:
-            cache_datetime = self.__cache[hash_digest]['datetime']
-            now = datetime.now()
-            delta = now - cache_datetime
-            delta_in_minutes = delta.total_seconds() / 60
-            if delta_in_minutes <= self.__CACHE_TTL_IN_MINUTES:
+        hash_digest = self.get_hash({
+            'region': self.__region,
+            'options': options
+        })
+        entry = self.__cache.get(hash_digest)
+        if entry is not None:
+            if time.monotonic() - entry['ts'] <= self.__ttl_seconds:
                 self.__logger.info(f'Cache hit for {hash_digest}')
-                return self.__cache[hash_digest]['result']
+                self.__cache.move_to_end(hash_digest)
+                return entry['result']
             else:
                 self.__logger.info(f'Cache expired for {hash_digest}')
-                del self.__cache[hash_digest]['result']
+                self.__cache.pop(hash_digest, None)
         else:
             self.__logger.info(f'Cache miss for {hash_digest}')
 
-        import logging
-        logging.getLogger("urllib3").setLevel(logging.ERROR)
         if options.get('vcpu') is None:
             raise Exception('A vcpu option is missing')
         if options.get('memory_gb') is None:
             raise Exception('A memory_gb option is missing')
+        top_k = options.get('top_k')
+        if top_k is not None and (not isinstance(top_k, int) or isinstance(top_k, bool) or top_k <= 0):
+            raise Exception(f'The top_k option must be a positive integer, got {top_k!r}')
 
         cpu = options['vcpu']
         memory_gb = options.get('memory_gb')
@@ -109,21 +167,11 @@ class Ec2BestInstance:
         availability_zones = options.get('availability_zones')
         final_spot_price_determination_strategy = options.get('final_spot_price_determination_strategy', 'min')
 
-        valid_product_descriptions = [
-            'Linux/UNIX',
-            'Red Hat Enterprise Linux',
-            'SUSE Linux',
-            'Windows',
-            'Linux/UNIX (Amazon VPC)',
-            'Red Hat Enterprise Linux (Amazon VPC)',
-            'SUSE Linux (Amazon VPC)',
-            'Windows (Amazon VPC)'
-        ]
         product_descriptions = options.get('product_descriptions', ['Linux/UNIX'])
         for product_description in product_descriptions:
-            if product_description not in valid_product_descriptions:
+            if product_description not in _VALID_PRODUCT_DESCRIPTIONS:
                 raise Exception(f'The product description {product_description} is not supported')
-        is_current_generation = None
+        is_current_generation = options.get('is_current_generation')
         is_best_price = options.get('is_best_price', False)
         is_instance_storage_supported = options.get('is_instance_storage_supported')
         max_interruption_frequency = options.get('max_interruption_frequency')
@@ -132,9 +180,6 @@ class Ec2BestInstance:
             raise Exception('You must specify products that are compatible with only one operating system')
         operating_system = operating_systems[0]
 
-        if options.get('is_current_generation') is not None:
-            is_current_generation = 'true' if options['is_current_generation'] == True else 'false'
-
         instances = self.__describe_instance_types({
             'is_current_generation': is_current_generation,
             'is_instance_storage_supported': is_instance_storage_supported
@@ -151,53 +196,45 @@ class Ec2BestInstance:
         self.__logger.debug(f'Instance types number before filtering: {str(len(instances))}')
 
         if usage_class == 'spot' and max_interruption_frequency is not None:
-            spot_utils = SpotUtils(self.__region)
+            interruption_frequencies = self.__get_spot_interruption_frequency(operating_system)
 
-            interruption_frequencies = spot_utils.get_spot_interruption_frequency(operating_system)
-
-            def interruption_frequency_statistic_existing_filter(ec2_instance):
-                instance_type = ec2_instance['InstanceType']
-                if interruption_frequencies.get(instance_type) is not None:
-                    return True
-                else:
-                    self.__logger.warning(
-                        f'Interruption frequency statistic is missing for {instance_type}, so instance type is ignored')
-                    return False
-
-            filtered_instances = list(filter(interruption_frequency_statistic_existing_filter, filtered_instances))
+            missing_instance_types = [ec2_instance['InstanceType'] for ec2_instance in filtered_instances
+                                      if ec2_instance['InstanceType'] not in interruption_frequencies]
+            self.__log_missing_interruption_frequencies(operating_system, missing_instance_types)
 
             def add_interruption_frequency(ec2_instance, interruption_frequency):
+                # Copy the instance type, so the cached catalog is not modified
+                ec2_instance = dict(ec2_instance)
                 ec2_instance['interruption_frequency'] = interruption_frequency
                 return ec2_instance
 
-            filtered_instances = list(map(lambda ec2_instance:
-                                          add_interruption_frequency(ec2_instance, interruption_frequencies[
-                                              ec2_instance['InstanceType']]),
-                                          filtered_instances))
-            filtered_instances = list(
-                filter(lambda ec2_instance: ec2_instance['interruption_frequency']['min'] <= max_interruption_frequency,
-                       filtered_instances))
+            filtered_instances = [
+                add_interruption_frequency(ec2_instance, interruption_frequencies[ec2_instance['InstanceType']])
+                for ec2_instance in filtered_instances
+                if ec2_instance['InstanceType'] in interruption_frequencies
+                and interruption_frequencies[ec2_instance['InstanceType']]['min'] <= max_interruption_frequency]
 
         self.__logger.debug(f'Instance types number after filtering: {str(len(filtered_instances))}')
 
         if is_best_price:
             if usage_class == 'on-demand':
                 instance_types = list(map(lambda ec2_instance: ec2_instance['InstanceType'], filtered_instances))
-                result = self.__sort_on_demand_instances_by_price(instance_types, operating_system)
+                result = self.__sort_on_demand_instances_by_price(instance_types, operating_system, top_k)
             elif usage_class == 'spot':
                 result = self.__sort_spot_instances_by_price(filtered_instances, product_descriptions,
                                                              availability_zones,
-                                                             final_spot_price_determination_strategy)
+                                                             final_spot_price_determination_strategy, top_k)
             else:
                 raise Exception(f'The usage_class: {usage_class} does not exist')
         else:
             result = list(map(lambda ec2_instance: {'instance_type': ec2_instance['InstanceType']}, filtered_instances))
 
-        hash_digest = self.get_hash(options)
         self.__cache[hash_digest] = {
             'result': result,
-            'datetime': datetime.now()
+            'ts': time.monotonic()
         }
+        if len(self.__cache) > self.__cache_max_entries:
+            self.__cache.popitem(last=False)
         return result
 
     def is_instance_storage_supported_for_instance_type(self, instance_type):
@@ -219,6 +256,34 @@ class Ec2BestInstance:
             is_current_generation = options.get('is_current_generation')
             is_instance_storage_supported = options.get('is_instance_storage_supported')
 
+        cache_key = (self.__region, is_current_generation, is_instance_storage_supported)
+        cached_instances = self.__get_cached_result(self.__instance_types_cache, cache_key)
+        if cached_instances is not None:
+            return cached_instances
+
+        if is_current_generation is not None:
+            instances = self.__describe_instance_types_pages(is_current_generation, is_instance_storage_supported)
+        else:
+            # NextToken values are chained, so a single listing can't be fanned out page by page.
+            # Instead, the catalog is split into the disjoint current and previous generation listings,
+            # which are paginated concurrently. Current generation instance types come first.
+            generations = [True, False]
+
+            results = self.__run_concurrently(self.__on_demand_executor, len(generations),
+                                              self.__describe_instance_types_pages,
+                                              [(generation, is_instance_storage_supported)
+                                               for generation in generations])
+
+            instances = []
+
+            for result in results:
+                instances += result
+
+        self.__set_cached_result(self.__instance_types_cache, cache_key, instances)
+
+        return instances
+
+    def __describe_instance_types_pages(self, is_current_generation=None, is_instance_storage_supported=None):
         instances = []
 
         response = self.__describe_instance_types_page(
@@ -240,99 +305,87 @@ class Ec2BestInstance:
 
     def __describe_instance_types_page(self, next_token=None, is_current_generation=None,
                                        is_instance_storage_supported=None):
-        filters = [] if is_current_generation is None else [{
-            'Name': 'current-generation',
-            'Values': [is_current_generation]
-        }]
+        filters = []
+
+        if is_current_generation is not None:
+            filters.append({
+                'Name': 'current-generation',
+                'Values': ['true' if is_current_generation else 'false']
+            })
 
         if is_instance_storage_supported is not None:
-            if is_instance_storage_supported:
-                filters.append({
-                    'Name': 'instance-storage-supported',
-                    'Values': ['true']
-                })
-            else:
-                filters.append({
-                    'Name': 'instance-storage-supported',
-                    'Values': ['false']
-                })
+            filters.append({
+                'Name': 'instance-storage-supported',
+                'Values': ['true' if is_instance_storage_supported else 'false']
+            })
+
+        kwargs = {
+            'Filters': filters
+        }
 
         if next_token is not None:
-            response = self.__ec2_client.describe_instance_types(
-                Filters=filters,
-                NextToken=next_token
-            )
-        else:
-            response = self.__ec2_client.describe_instance_types(
-                Filters=filters
-            )
+            kwargs['NextToken'] = next_token
 
-        return response
+        return self.__ec2_client.describe_instance_types(**kwargs)
 
     def __filter_ec2_instances(self, instances, options):
         if options is None:
             return []
 
-        filtered_instances = []
-
-        if options.get('cpu') is not None:
-            filtered_instances = list(
-                filter(lambda ec2_instance: ec2_instance['VCpuInfo']['DefaultVCpus'] >= options.get('cpu'), instances))
-        if options.get('memory_gb') is not None:
-            filtered_instances = list(
-                filter(lambda ec2_instance: ec2_instance['MemoryInfo']['SizeInMiB'] >= options.get('memory_gb') * 1024,
-                       filtered_instances))
-        if options.get('usage_class') is not None:
-            filtered_instances = list(
-                filter(lambda ec2_instance: options.get('usage_class') in ec2_instance['SupportedUsageClasses'],
-                       filtered_instances))
-        if options.get('burstable') is not None:
-            filtered_instances = list(
-                filter(lambda ec2_instance: options.get('burstable') == ec2_instance['BurstablePerformanceSupported'],
-                       filtered_instances))
-        if options.get('architecture') is not None:
-            filtered_instances = list(
-                filter(lambda ec2_instance: options.get('architecture') in ec2_instance['ProcessorInfo'][
-                    'SupportedArchitectures'],
-                       filtered_instances))
-
-        return filtered_instances
-
-    def __ec2_instance_price_loop(self, ec2_instance, product_descriptions, availability_zones,
-                                  final_spot_price_determination_strategy):
-        instance_type = ec2_instance['InstanceType']
+        cpu = options.get('cpu')
+        memory_gb = options.get('memory_gb')
+        memory_mib = memory_gb * 1024 if memory_gb is not None else None
+        usage_class = options.get('usage_class')
+        burstable = options.get('burstable')
+        architecture = options.get('architecture')
+
+        return [ec2_instance for ec2_instance in instances
+                if (cpu is None or ec2_instance['VCpuInfo']['DefaultVCpus'] >= cpu)
+                and (memory_mib is None or ec2_instance['MemoryInfo']['SizeInMiB'] >= memory_mib)
+                and (usage_class is None or usage_class in ec2_instance['SupportedUsageClasses'])
+                and (burstable is None or burstable == ec2_instance['BurstablePerformanceSupported'])
+                and (architecture is None or architecture in ec2_instance['ProcessorInfo']['SupportedArchitectures'])]
+
+    def __describe_spot_price_history(self, instance_types, filters):
+        # With StartTime set to now, only the current price of every instance type, availability zone
+        # and product description is returned instead of the whole price history
+        start_time = datetime.now(timezone.utc)
+
+        history_events = {}
+
+        kwargs = {
+            'InstanceTypes': instance_types,
+            'Filters': filters,
+            'StartTime': start_time
+        }
 
-        filters = [
-            {
-                'Name': 'product-description',
-                'Values': product_descriptions
-            }
-        ]
+        while True:
+            response = self.__ec2_client.describe_spot_price_history(**kwargs)
+            for history_event in response['SpotPriceHistory']:
+                history_events.setdefault(history_event['InstanceType'], []).append(history_event)
+            # An empty NextToken is returned on the last page
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
 
-        if availability_zones:
-            filters.append({
-                'Name': 'availability-zone',
-                'Values': availability_zones
-            })
-
-        response = self.__ec2_client.describe_spot_price_history(
-            InstanceTypes=[instance_type],
-            Filters=filters
-        )
+        return history_events
 
-        if len(response['SpotPriceHistory']) == 0:
-            return None
+    @staticmethod
+    def __ec2_instance_price_loop(ec2_instance, history_events, availability_zones,
+                                  final_spot_price_determination_strategy):
+        # History events are ordered from the most recent, so keep the first price per availability zone
+        az_to_price = {}
 
-        history_events = response['SpotPriceHistory']
+        for history_event in history_events:
+            az_to_price.setdefault(history_event['AvailabilityZone'], history_event['SpotPrice'])
 
-        az_price = {}
+        if availability_zones:
+            az_price = {az: az_to_price[az] for az in availability_zones if az in az_to_price}
+        else:
+            az_price = az_to_price
 
-        for i, availability_zone in enumerate(availability_zones):
-            for history_event in history_events:
-                az = history_event['AvailabilityZone']
-                if availability_zone == az:
-                    az_price[availability_zone] = history_event['SpotPrice']
-                    break
+        if not az_price:
+            return None
 
         strategy = final_spot_price_determination_strategy
 
@@ -354,23 +407,44 @@ class Ec2BestInstance:
         }
 
     def __sort_spot_instances_by_price(self, filtered_instances, product_descriptions, availability_zones,
-                                       final_spot_price_determination_strategy):
-        pool = self.__Pool(self.__describe_spot_price_history_concurrency)
+                                       final_spot_price_determination_strategy, top_k=None):
+        # The filters are the same for every instance type, so they are built once
+        filters = [
+            {
+                'Name': 'product-description',
+                'Values': product_descriptions
+            }
+        ]
 
-        results = []
+        if availability_zones:
+            filters.append({
+                'Name': 'availability-zone',
+                'Values': availability_zones
+            })
 
-        for ec2_instance in filtered_instances:
-            result = pool.apply_async(self.__ec2_instance_price_loop,
-                                      (ec2_instance, product_descriptions, availability_zones,
-                                       final_spot_price_determination_strategy))
-            results.append(result)
+        # DescribeSpotPriceHistory accepts a list of instance types, so they are requested in batches
+        batch_size = self.__DESCRIBE_SPOT_PRICE_HISTORY_BATCH_SIZE
+        batches = [[ec2_instance['InstanceType'] for ec2_instance in filtered_instances[i:i + batch_size]]
+                   for i in range(0, len(filtered_instances), batch_size)]
 
-        pool.close()
-        pool.join()
+        results = self.__run_concurrently(self.__spot_executor, self.__describe_spot_price_history_concurrency,
+                                          self.__describe_spot_price_history,
+                                          [(batch, filters) for batch in batches])
 
-        ec2_instances = [result.get() for result in results]
+        history_events = {}
+
+        for result in results:
+            history_events.update(result)
+
+        ec2_instances = [self.__ec2_instance_price_loop(ec2_instance,
+                                                        history_events.get(ec2_instance['InstanceType'], []),
+                                                        availability_zones, final_spot_price_determination_strategy)
+                         for ec2_instance in filtered_instances]
         ec2_instances = [ec2_instance for ec2_instance in ec2_instances if ec2_instance is not None]
-        ec2_instances.sort(key=operator.itemgetter('price'))
+        # Ties are broken by the instance type to keep the output stable
+        ec2_instances = self.__cheapest(ec2_instances, top_k,
+                                        lambda ec2_instance: (ec2_instance['price'],
+                                                              ec2_instance['ec2_instance']['InstanceType']))
 
         enriched_instances = []
 
@@ -390,8 +464,8 @@ class Ec2BestInstance:
 
         return enriched_instances
 
-    def __sort_on_demand_instances_by_price(self, instance_types, operating_system):
-        ec2_prices = self.__get_ec2_price(operating_system)
+    def __sort_on_demand_instances_by_price(self, instance_types, operating_system, top_k=None):
+        ec2_prices = self.__get_ec2_price_for_instance_types(instance_types, operating_system)
         ec2_instances = []
 
         for instance_type in instance_types:
@@ -404,66 +478,201 @@ class Ec2BestInstance:
             else:
                 self.__logger.warning(f'Price for the {instance_type} instance type not found')
 
-        ec2_instances.sort(key=operator.itemgetter('price'))
+        return self.__cheapest(ec2_instances, top_k, operator.itemgetter('price'))
+
+    def __get_ec2_price_for_instance_types(self, instance_types, operating_system):
+        # A fresh full price list is reused as is
+        cached_records = self.__get_cached_result(self.__ec2_price_cache, (self.__region, operating_system))
+        if cached_records is not None:
+            return cached_records
+
+        # Scanning the whole price list is cheaper than one lookup per instance type for a large number of types
+        if len(instance_types) > self.__ON_DEMAND_PRICE_LOOKUP_MAX_INSTANCE_TYPES:
+            return self.__get_ec2_price(operating_system)
+
+        results = self.__run_concurrently(self.__on_demand_executor, self.__describe_on_demand_price_concurrency,
+                                          self.__get_ec2_price_by_instance_type,
+                                          [(operating_system, instance_type) for instance_type in instance_types])
+
+        records = {}
+
+        for result in results:
+            records.update(result)
+
+        return records
+
+    def __get_ec2_price_by_instance_type(self, operating_system, instance_type):
+        cache_key = (self.__region, operating_system, instance_type)
+        cached_records = self.__get_cached_result(self.__ec2_price_cache, cache_key)
+        if cached_records is not None:
+            return cached_records
+
+        records = {}
+
+        for response in self.__get_ec2_price_pages(operating_system, instance_type):
+            records.update(self.__parse_ec2_price_list(response['PriceList']))
 
-        return ec2_instances
+        self.__set_cached_result(self.__ec2_price_cache, cache_key, records)
+
+        return records
 
     def __get_ec2_price(self, operating_system):
-        next_token = ''
+        cache_key = (self.__region, operating_system)
+        cached_records = self.__get_cached_result(self.__ec2_price_cache, cache_key)
+        if cached_records is not None:
+            return cached_records
+
+        # Pricing NextToken values are chained, so pages are fetched one after another while
+        # the price lists of the already fetched pages are parsed on the thread pool.
+        results = self.__run_concurrently(self.__on_demand_executor, self.__describe_on_demand_price_concurrency,
+                                          self.__parse_ec2_price_list,
+                                          ((response['PriceList'],)
+                                           for response in self.__get_ec2_price_pages(operating_system)))
+
         records = {}
+
+        for result in results:
+            records.update(result)
+
+        self.__set_cached_result(self.__ec2_price_cache, cache_key, records)
+
+        return records
+
+    def __get_ec2_price_pages(self, operating_system, instance_type=None):
+        next_token = ''
         while next_token is not None:
-            response = self.__pricing_client.get_products(
-                ServiceCode='AmazonEC2',
-                Filters=[
-                    {'Type': 'TERM_MATCH', 'Field': 'preInstalledSw', 'Value': 'NA'},
-                    # {'Type': 'TERM_MATCH', 'Field': 'storage', 'Value': 'EBS only'},
-                    {'Type': 'TERM_MATCH', 'Field': 'productFamily', 'Value': 'Compute Instance'},
-                    {'Type': 'TERM_MATCH', 'Field': 'termType', 'Value': 'OnDemand'},
-                    {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': self.__REGIONS[self.__region]},
-                    {'Type': 'TERM_MATCH', 'Field': 'licenseModel', 'Value': 'No License required'},
-                    {'Type': 'TERM_MATCH', 'Field': 'tenancy', 'Value': 'Shared'},
-                    {'Type': 'TERM_MATCH', 'Field': 'capacitystatus', 'Value': 'Used'},
-                    {'Type': 'TERM_MATCH', 'Field': 'operatingSystem', 'Value': operating_system}
-                ],
-                NextToken=next_token
-            )
-            try:
-                next_token = response['NextToken']
-            except KeyError:
-                next_token = None
-            for price in response['PriceList']:
-                details = json.loads(price)
-                pricedimensions = next(iter(details['terms']['OnDemand'].values()))['priceDimensions']
-                pricing_details = next(iter(pricedimensions.values()))
-                instance_price = float(pricing_details['pricePerUnit']['USD'])
-                instance_type = details['product']['attributes']['instanceType']
-                if instance_price <= 0:
-                    continue
-                vcpu = details['product']['attributes']['vcpu']
-                memory = details['product']['attributes']['memory'].split(" ")[0]
-                os = json.loads(price)['product']['attributes']['operatingSystem']
-                records[instance_type] = {
-                    'instance_type': instance_type,
-                    'vcpu': vcpu,
-                    'memory': memory,
-                    'os': os,
-                    'instance_price': instance_price
-                }
+            response = self.__get_ec2_price_page(operating_system, next_token, instance_type)
+            next_token = response.get('NextToken')
+            yield response
+
+    def __get_ec2_price_page(self, operating_system, next_token='', instance_type=None):
+        filters = [
+            {'Type': 'TERM_MATCH', 'Field': 'preInstalledSw', 'Value': 'NA'},
+            # {'Type': 'TERM_MATCH', 'Field': 'storage', 'Value': 'EBS only'},
+            {'Type': 'TERM_MATCH', 'Field': 'productFamily', 'Value': 'Compute Instance'},
+            {'Type': 'TERM_MATCH', 'Field': 'termType', 'Value': 'OnDemand'},
+            {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': self.__REGIONS[self.__region]},
+            {'Type': 'TERM_MATCH', 'Field': 'licenseModel', 'Value': 'No License required'},
+            {'Type': 'TERM_MATCH', 'Field': 'tenancy', 'Value': 'Shared'},
+            {'Type': 'TERM_MATCH', 'Field': 'capacitystatus', 'Value': 'Used'},
+            {'Type': 'TERM_MATCH', 'Field': 'operatingSystem', 'Value': operating_system}
+        ]
+
+        if instance_type is not None:
+            filters.append({'Type': 'TERM_MATCH', 'Field': 'instanceType', 'Value': instance_type})
+
+        return self.__pricing_client.get_products(
+            ServiceCode='AmazonEC2',
+            Filters=filters,
+            NextToken=next_token
+        )
+
+    @staticmethod
+    def __parse_ec2_price_list(price_list):
+        records = {}
+        for price in price_list:
+            details = json_loads(price)
+            pricedimensions = next(iter(details['terms']['OnDemand'].values()))['priceDimensions']
+            pricing_details = next(iter(pricedimensions.values()))
+            instance_price = float(pricing_details['pricePerUnit']['USD'])
+            instance_type = details['product']['attributes']['instanceType']
+            if instance_price <= 0:
+                continue
+            vcpu = details['product']['attributes']['vcpu']
+            memory = details['product']['attributes']['memory'].split(" ")[0]
+            os = details['product']['attributes']['operatingSystem']
+            records[instance_type] = {
+                'instance_type': instance_type,
+                'vcpu': vcpu,
+                'memory': memory,
+                'os': os,
+                'instance_price': instance_price
+            }
         return records
 
+    def __get_spot_interruption_frequency(self, operating_system):
+        cache_key = (self.__region, operating_system)
+        cached_interruption_frequencies = self.__get_cached_result(self.__interruption_frequencies_cache, cache_key)
+        if cached_interruption_frequencies is not None:
+            return cached_interruption_frequencies
+
+        if self.__spot_utils is None:
+            self.__spot_utils = SpotUtils(self.__region)
+
+        interruption_frequencies = self.__spot_utils.get_spot_interruption_frequency(operating_system)
+
+        if interruption_frequencies is not None:
+            self.__set_cached_result(self.__interruption_frequencies_cache, cache_key, interruption_frequencies)
+
+        return interruption_frequencies
+
+    def __log_missing_interruption_frequencies(self, operating_system, missing_instance_types):
+        # Instance types without the statistic are logged once per region and operating system
+        cache_key = (self.__region, operating_system)
+        known_missing_instance_types = self.__get_cached_result(self.__missing_interruption_frequencies_cache,
+                                                                cache_key) or frozenset()
+        new_missing_instance_types = [instance_type for instance_type in missing_instance_types
+                                      if instance_type not in known_missing_instance_types]
+        if not new_missing_instance_types:
+            return
+
+        self.__logger.debug('Interruption frequency statistic is missing for %d instance types, '
+                            'so they are ignored: %s', len(new_missing_instance_types), new_missing_instance_types[:10])
+        self.__set_cached_result(self.__missing_interruption_frequencies_cache, cache_key,
+                                 known_missing_instance_types.union(new_missing_instance_types))
+
+    def __run_concurrently(self, executor, concurrency, func, args_list):
+        # Results keep the order of args_list. If args_list is a generator, every task is submitted
+        # as soon as its arguments are produced.
+        if executor is not None:
+            futures = [executor.submit(func, *args) for args in args_list]
+            return [future.result() for future in futures]
+
+        pool = self.__Pool(concurrency)
+
+        results = []
+
+        for args in args_list:
+            result = pool.apply_async(func, args)
+            results.append(result)
+
+        pool.close()
+        pool.join()
+
+        return [result.get() for result in results]
+
+    def __get_cached_result(self, cache, key):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry['ts'] <= self.__ttl_seconds:
+            return entry['result']
+        cache.pop(key, None)
+        return None
+
+    @staticmethod
+    def __set_cached_result(cache, key, result):
+        cache[key] = {
+            'result': result,
+            'ts': time.monotonic()
+        }
+
     def __get_operating_systems_by_product_descriptions(self, product_descriptions):
-        operating_systems = [self.__OS_PRODUCT_DESCRIPTION_MAP[product_description] for product_description in
-                             product_descriptions]
-        return Ec2BestInstance.unique(operating_systems)
+        return list(dict.fromkeys(_OS_PRODUCT_DESCRIPTION_MAP[product_description] for product_description in
+                                  product_descriptions))
+
+    @staticmethod
+    def __cheapest(items, top_k, key):
+        if top_k is not None:
+            return heapq.nsmallest(top_k, items, key=key)
+        return sorted(items, key=key)
 
     @staticmethod
     def unique(list1):
-        list_set = set(list1)
-        unique_list = (list(list_set))
-        return unique_list
+        return list(dict.fromkeys(list1))
 
     @staticmethod
     def get_hash(dictionary):
-        dict_string = json.dumps(dictionary)
-        hash_object = hashlib.md5(dict_string.encode())
+        dict_string = json.dumps(dictionary, sort_keys=True, default=str)
+        hash_object = hashlib.blake2b(dict_string.encode(), digest_size=16)
         return hash_object.hexdigest()